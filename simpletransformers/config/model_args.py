@@ -387,7 +387,11 @@ class ConvAIArgs(ModelArgs):
     """
 
     model_class: str = "ConvAIModel"
+    bf16: bool = False
+    dataloader_pin_memory: bool = True
+    dataloader_prefetch_factor: int = 2
     do_sample: bool = True
+    gradient_checkpointing: bool = False
     lm_coef: float = 2.0
     max_history: int = 2
     max_length: int = 20
@@ -398,6 +402,8 @@ class ConvAIArgs(ModelArgs):
     temperature: float = 0.7
     top_k: float = 0
     top_p: float = 0.9
+    torch_compile: bool = False
+    torch_compile_mode: str = "default"
 
 
 @dataclass
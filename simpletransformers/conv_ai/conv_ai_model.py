@@ -4,32 +4,26 @@
 
 from __future__ import absolute_import, division, print_function
 
+import contextlib
+import csv
 import json
 import logging
 import math
 import os
 import random
-import statistics
+import re
 import warnings
 from collections import defaultdict
 from dataclasses import asdict
-from itertools import chain
-from multiprocessing import cpu_count
+from functools import partial
+from multiprocessing import Pool, cpu_count
 
 import numpy as np
-import pandas as pd
 import torch
 import torch.nn.functional as F
-from scipy.stats import mode, pearsonr
-from sklearn.metrics import (
-    confusion_matrix,
-    f1_score,
-    label_ranking_average_precision_score,
-    matthews_corrcoef,
-    mean_squared_error,
-)
+from torch.cuda import amp
 from torch.utils.tensorboard import SummaryWriter
-from torch.utils.data import DataLoader, RandomSampler, SequentialSampler, TensorDataset
+from torch.utils.data import DataLoader, RandomSampler, SequentialSampler
 from torch.utils.data.distributed import DistributedSampler
 from tqdm.auto import tqdm, trange
 from transformers.optimization import (
@@ -45,7 +39,7 @@ from transformers import (
     WEIGHTS_NAME,
     GPT2Config,
     GPT2DoubleHeadsModel,
-    GPT2Tokenizer,
+    GPT2TokenizerFast,
     OpenAIGPTConfig,
     OpenAIGPTDoubleHeadsModel,
     OpenAIGPTTokenizer,
@@ -62,7 +56,15 @@ from simpletransformers.classification.classification_utils import (
 from simpletransformers.config.global_args import global_args
 from simpletransformers.config.model_args import ConvAIArgs
 from simpletransformers.config.utils import sweep_config_to_sweep_values
-from simpletransformers.conv_ai.conv_ai_utils import get_dataset
+from simpletransformers.conv_ai.conv_ai_utils import (
+    ConvAIDataset,
+    build_dialog_instances,
+    build_input_from_segments,
+    convert_conv1d_to_linear,
+    get_dataset,
+    pad_collate,
+    prefetch_to_device,
+)
 
 try:
     import wandb
@@ -80,8 +82,6 @@ ATTR_TO_SPECIAL_TOKEN = {
     "pad_token": "<pad>",
     "additional_special_tokens": ["<speaker1>", "<speaker2>"],
 }
-MODEL_INPUTS = ["input_ids", "mc_token_ids", "labels", "mc_labels", "token_type_ids"]
-PADDED_INPUTS = ["input_ids", "labels", "token_type_ids"]
 
 
 class ConvAIModel:
@@ -109,7 +109,7 @@ class ConvAIModel:
 
         MODEL_CLASSES = {
             "gpt": (OpenAIGPTConfig, OpenAIGPTDoubleHeadsModel, OpenAIGPTTokenizer),
-            "gpt2": (GPT2Config, GPT2DoubleHeadsModel, GPT2Tokenizer),
+            "gpt2": (GPT2Config, GPT2DoubleHeadsModel, GPT2TokenizerFast),
             "blender-small": (
                 BlenderbotConfig,
                 BlenderbotForConditionalGeneration,
@@ -144,6 +144,11 @@ class ConvAIModel:
             if self.args.n_gpu > 0:
                 torch.cuda.manual_seed_all(self.args.manual_seed)
 
+        if self.args.local_rank != -1:
+            logger.info(f"local_rank: {self.args.local_rank}")
+            torch.distributed.init_process_group(backend="nccl")
+            cuda_device = self.args.local_rank
+
         if not use_cuda:
             self.args.fp16 = False
 
@@ -161,15 +166,44 @@ class ConvAIModel:
                 None, config=self.config, state_dict=quantized_weights
             )
 
+        if self.args.gradient_checkpointing:
+            if getattr(self.model, "supports_gradient_checkpointing", False):
+                self.model.gradient_checkpointing_enable()
+                # The key/value cache is unused during training and incompatible with checkpointing
+                self.model.config.use_cache = False
+            else:
+                warnings.warn(
+                    f"gradient_checkpointing is not supported for model_type {model_type}."
+                    " Gradient checkpointing disabled."
+                )
+                self.args.gradient_checkpointing = False
+
         self.tokenizer = tokenizer_class.from_pretrained(model_name, **kwargs)
+        # The model stays on the CPU until _move_model_to_device() so that resizing the
+        # embeddings does not hold both embedding matrices in GPU memory
         self.add_special_tokens_(self.model, self.tokenizer)
+        # Looked up once here as they are needed for every input built from segments
+        self._special_token_ids = self.tokenizer.convert_tokens_to_ids(SPECIAL_TOKENS)
+        # Personalities are loaded from the PERSONA-CHAT dataset on the first interaction
+        self._cached_personalities = None
 
         if self.args.dynamic_quantize:
+            # Models quantized before the Conv1D conversion was added saved their Conv1D
+            # weights unquantized, so they have to be loaded into Conv1D layers again
+            legacy_quantized_weights = self.args.quantized_model and any(
+                key.endswith(".c_attn.weight") for key in quantized_weights
+            )
+            if model_type in ["gpt", "gpt2"] and not legacy_quantized_weights:
+                # GPT attention and MLP projections are Conv1D, which quantize_dynamic ignores
+                self.model = convert_conv1d_to_linear(self.model)
             self.model = torch.quantization.quantize_dynamic(
                 self.model, {torch.nn.Linear}, dtype=torch.qint8
             )
         if self.args.quantized_model:
+            # The saved weights only match the model structure once it has been quantized,
+            # so they are loaded again here and then released
             self.model.load_state_dict(quantized_weights)
+            del quantized_weights
         if self.args.dynamic_quantize:
             self.args.quantized_model = True
 
@@ -312,7 +346,10 @@ class ConvAIModel:
         model = self.model
         args = self.args
 
-        tb_writer = SummaryWriter(log_dir=args.tensorboard_dir)
+        # In distributed training only one process writes checkpoints, logs and scores
+        is_world_master = self.is_world_master()
+        if is_world_master:
+            tb_writer = SummaryWriter(log_dir=args.tensorboard_dir)
 
         t_total = (
             len(train_dataloader)
@@ -321,6 +358,10 @@ class ConvAIModel:
         )
 
         no_decay = ["bias", "LayerNorm.weight"]
+        no_decay_pattern = re.compile("|".join(re.escape(nd) for nd in no_decay))
+
+        named_parameters = list(model.named_parameters())
+        no_decay_names = {n for n, p in named_parameters if no_decay_pattern.search(n)}
 
         optimizer_grouped_parameters = []
         custom_parameter_names = set()
@@ -328,53 +369,52 @@ class ConvAIModel:
             params = group.pop("params")
             custom_parameter_names.update(params)
             param_group = {**group}
-            param_group["params"] = [
-                p for n, p in model.named_parameters() if n in params
-            ]
+            param_group["params"] = [p for n, p in named_parameters if n in params]
             optimizer_grouped_parameters.append(param_group)
 
+        layer_groups = []
         for group in self.args.custom_layer_parameters:
             layer_number = group.pop("layer")
             layer = f"layer.{layer_number}."
             group_d = {**group}
             group_nd = {**group}
             group_nd["weight_decay"] = 0.0
-            params_d = []
-            params_nd = []
-            for n, p in model.named_parameters():
-                if n not in custom_parameter_names and layer in n:
-                    if any(nd in n for nd in no_decay):
-                        params_nd.append(p)
-                    else:
-                        params_d.append(p)
-                    custom_parameter_names.add(n)
-            group_d["params"] = params_d
-            group_nd["params"] = params_nd
+            group_d["params"] = []
+            group_nd["params"] = []
+            layer_groups.append((layer, group_d, group_nd))
+
+        if layer_groups:
+            # Each parameter goes to the first custom layer group that matches it
+            for n, p in named_parameters:
+                if n in custom_parameter_names:
+                    continue
+                for layer, group_d, group_nd in layer_groups:
+                    if layer in n:
+                        if n in no_decay_names:
+                            group_nd["params"].append(p)
+                        else:
+                            group_d["params"].append(p)
+                        custom_parameter_names.add(n)
+                        break
 
+        for _, group_d, group_nd in layer_groups:
             optimizer_grouped_parameters.append(group_d)
             optimizer_grouped_parameters.append(group_nd)
 
         if not self.args.train_custom_parameters_only:
+            params_d = []
+            params_nd = []
+            for n, p in named_parameters:
+                if n in custom_parameter_names:
+                    continue
+                if n in no_decay_names:
+                    params_nd.append(p)
+                else:
+                    params_d.append(p)
             optimizer_grouped_parameters.extend(
                 [
-                    {
-                        "params": [
-                            p
-                            for n, p in model.named_parameters()
-                            if n not in custom_parameter_names
-                            and not any(nd in n for nd in no_decay)
-                        ],
-                        "weight_decay": args.weight_decay,
-                    },
-                    {
-                        "params": [
-                            p
-                            for n, p in model.named_parameters()
-                            if n not in custom_parameter_names
-                            and any(nd in n for nd in no_decay)
-                        ],
-                        "weight_decay": 0.0,
-                    },
+                    {"params": params_d, "weight_decay": args.weight_decay},
+                    {"params": params_nd, "weight_decay": 0.0},
                 ]
             )
 
@@ -453,13 +493,25 @@ class ConvAIModel:
         else:
             raise ValueError("{} is not a valid scheduler.".format(args.scheduler))
 
-        if args.n_gpu > 1:
+        model = self._compile_model(model)
+
+        # Distributed training
+        if args.local_rank != -1:
+            model = torch.nn.parallel.DistributedDataParallel(
+                model,
+                device_ids=[args.local_rank],
+                output_device=args.local_rank,
+                find_unused_parameters=False,
+            )
+        elif args.n_gpu > 1:
             model = torch.nn.DataParallel(model)
 
         global_step = 0
         training_progress_scores = None
-        tr_loss, logging_loss = 0.0, 0.0
-        model.zero_grad()
+        # Accumulated on the device so that the loss is only synced at logging steps
+        tr_loss = torch.zeros((), device=device)
+        logging_loss = 0.0
+        model.zero_grad(set_to_none=True)
         train_iterator = trange(
             int(args.num_train_epochs), desc="Epoch", disable=args.silent
         )
@@ -468,9 +520,29 @@ class ConvAIModel:
         early_stopping_counter = 0
 
         if args.evaluate_during_training:
-            training_progress_scores = self._create_training_progress_scores(**kwargs)
+            num_evaluations = 0
+            if args.evaluate_during_training_steps > 0:
+                num_evaluations += (
+                    len(train_dataloader)
+                    * int(args.num_train_epochs)
+                    // args.gradient_accumulation_steps
+                    // args.evaluate_during_training_steps
+                )
+            if args.evaluate_each_epoch:
+                num_evaluations += int(args.num_train_epochs)
+            training_progress_scores = self._create_training_progress_scores(
+                num_evaluations, **kwargs
+            )
+            num_scores = 0
+            training_progress_scores_file = os.path.join(
+                args.output_dir, "training_progress_scores.csv"
+            )
+            # Write the header once. Each evaluation appends a single row after this.
+            if is_world_master:
+                with open(training_progress_scores_file, "w", newline="") as f:
+                    csv.writer(f).writerow(training_progress_scores.keys())
 
-        if args.wandb_project:
+        if args.wandb_project and is_world_master:
             wandb.init(
                 project=args.wandb_project,
                 config={**asdict(args)},
@@ -480,13 +552,28 @@ class ConvAIModel:
             wandb.watch(self.model)
             self.wandb_run_id = wandb.run.id
 
-        if args.fp16:
-            from torch.cuda import amp
-
-            scaler = amp.GradScaler()
+        use_bf16 = self._use_bf16()
+        if args.bf16 and not use_bf16:
+            warnings.warn("bf16 is not supported on this device. bf16 disabled.")
+
+        # bf16 has the same dynamic range as fp32 so the loss does not need to be scaled
+        scaler = amp.GradScaler() if args.fp16 and not use_bf16 else None
+
+        # Settings read on every step are looked up once. The periodic logging, saving and
+        # evaluation are triggered by counters rather than a modulo check on global_step.
+        gradient_accumulation_steps = args.gradient_accumulation_steps
+        lm_coef, mc_coef = args.lm_coef, args.mc_coef
+        logging_steps = args.logging_steps
+        save_steps = args.save_steps
+        evaluate_steps = (
+            args.evaluate_during_training_steps if args.evaluate_during_training else 0
+        )
+        steps_since_logging = steps_since_saving = steps_since_evaluation = 0
 
-        for _ in train_iterator:
+        for current_epoch in train_iterator:
             model.train()
+            if isinstance(train_dataloader.sampler, DistributedSampler):
+                train_dataloader.sampler.set_epoch(current_epoch)
             train_iterator.set_description(
                 f"Epoch {epoch_number + 1} of {args.num_train_epochs}"
             )
@@ -496,24 +583,11 @@ class ConvAIModel:
                 disable=args.silent,
                 mininterval=0,
             )
-            for step, batch in enumerate(batch_iterator):
-                batch = tuple(t.to(device) for t in batch)
+            for step, batch in enumerate(prefetch_to_device(batch_iterator, device)):
                 input_ids, mc_token_ids, labels, mc_labels, token_type_ids = batch
+                optimizer_step = (step + 1) % gradient_accumulation_steps == 0
 
-                if args.fp16:
-                    with amp.autocast():
-                        outputs = model(
-                            input_ids,
-                            token_type_ids=token_type_ids,
-                            mc_token_ids=mc_token_ids,
-                            mc_labels=mc_labels,
-                            labels=labels,
-                        )
-
-                        lm_loss, mc_loss = outputs[:2]
-                        # model outputs are always tuple in pytorch-transformers (see doc)
-                        loss = lm_loss * args.lm_coef + mc_loss * args.mc_coef
-                else:
+                with self._get_autocast(use_bf16):
                     outputs = model(
                         input_ids,
                         token_type_ids=token_type_ids,
@@ -524,65 +598,78 @@ class ConvAIModel:
 
                     lm_loss, mc_loss = outputs[:2]
                     # model outputs are always tuple in pytorch-transformers (see doc)
-                    loss = lm_loss * args.lm_coef + mc_loss * args.mc_coef
+                    loss = lm_loss * lm_coef + mc_loss * mc_coef
 
-                if args.n_gpu > 1:
+                if isinstance(model, torch.nn.DataParallel):
                     loss = (
                         loss.mean()
                     )  # mean() to average on multi-gpu parallel training
 
-                current_loss = loss.item()
+                current_loss = loss.detach()
 
-                if show_running_loss:
-                    print("\rRunning loss: %f" % current_loss, end="")
+                if show_running_loss and step % 10 == 0:
+                    print("\rRunning loss: %f" % current_loss.item(), end="")
 
-                if args.gradient_accumulation_steps > 1:
-                    loss = loss / args.gradient_accumulation_steps
+                if gradient_accumulation_steps > 1:
+                    loss = loss / gradient_accumulation_steps
 
-                if args.fp16:
-                    scaler.scale(loss).backward()
+                # Gradients are only all-reduced on the step where the optimizer is updated
+                if not optimizer_step and hasattr(model, "no_sync"):
+                    sync_context = model.no_sync()
                 else:
-                    loss.backward()
+                    sync_context = contextlib.nullcontext()
+
+                with sync_context:
+                    if scaler is not None:
+                        scaler.scale(loss).backward()
+                    else:
+                        loss.backward()
 
-                tr_loss += loss.item()
-                if (step + 1) % args.gradient_accumulation_steps == 0:
-                    if args.fp16:
+                tr_loss += loss.detach()
+                if optimizer_step:
+                    if scaler is not None:
                         scaler.unscale_(optimizer)
                     if args.optimizer == "AdamW":
                         torch.nn.utils.clip_grad_norm_(
                             model.parameters(), args.max_grad_norm
                         )
 
-                    if args.fp16:
+                    if scaler is not None:
                         scaler.step(optimizer)
                         scaler.update()
                     else:
                         optimizer.step()
                     scheduler.step()  # Update learning rate schedule
-                    model.zero_grad()
+                    model.zero_grad(set_to_none=True)
                     global_step += 1
+                    steps_since_logging += 1
+                    steps_since_saving += 1
+                    steps_since_evaluation += 1
 
-                    if args.logging_steps > 0 and global_step % args.logging_steps == 0:
+                    if steps_since_logging == logging_steps:
+                        steps_since_logging = 0
                         # Log metrics
-                        tb_writer.add_scalar(
-                            "lr", scheduler.get_last_lr()[0], global_step
-                        )
-                        tb_writer.add_scalar(
-                            "loss",
-                            (tr_loss - logging_loss) / args.logging_steps,
-                            global_step,
-                        )
-                        logging_loss = tr_loss
-                        if args.wandb_project or self.is_sweeping:
+                        tr_loss_value = tr_loss.item()
+                        current_lr = scheduler.get_last_lr()[0]
+                        if is_world_master:
+                            tb_writer.add_scalar("lr", current_lr, global_step)
+                            tb_writer.add_scalar(
+                                "loss",
+                                (tr_loss_value - logging_loss) / logging_steps,
+                                global_step,
+                            )
+                        logging_loss = tr_loss_value
+                        if (args.wandb_project or self.is_sweeping) and is_world_master:
                             wandb.log(
                                 {
-                                    "Training loss": current_loss,
-                                    "lr": scheduler.get_last_lr()[0],
+                                    "Training loss": current_loss.item(),
+                                    "lr": current_lr,
                                     "global_step": global_step,
                                 }
                             )
 
-                    if args.save_steps > 0 and global_step % args.save_steps == 0:
+                    if steps_since_saving == save_steps:
+                        steps_since_saving = 0
                         # Save model checkpoint
                         output_dir_current = os.path.join(
                             output_dir, "checkpoint-{}".format(global_step)
@@ -590,10 +677,8 @@ class ConvAIModel:
 
                         self.save_model(output_dir_current, model=model)
 
-                    if args.evaluate_during_training and (
-                        args.evaluate_during_training_steps > 0
-                        and global_step % args.evaluate_during_training_steps == 0
-                    ):
+                    if steps_since_evaluation == evaluate_steps:
+                        steps_since_evaluation = 0
                         # Only evaluate when single GPU otherwise metrics may not average well
                         results, _, _ = self.eval_model(
                             eval_dataloader,
@@ -601,13 +686,14 @@ class ConvAIModel:
                             silent=args.evaluate_during_training_silent,
                             **kwargs,
                         )
-                        for key, value in results.items():
-                            try:
-                                tb_writer.add_scalar(
-                                    "eval_{}".format(key), value, global_step
-                                )
-                            except (NotImplementedError, AssertionError):
-                                pass
+                        if is_world_master:
+                            for key, value in results.items():
+                                try:
+                                    tb_writer.add_scalar(
+                                        "eval_{}".format(key), value, global_step
+                                    )
+                                except (NotImplementedError, AssertionError):
+                                    pass
 
                         output_dir_current = os.path.join(
                             output_dir, "checkpoint-{}".format(global_step)
@@ -618,20 +704,26 @@ class ConvAIModel:
                                 output_dir_current, model=model, results=results
                             )
 
-                        training_progress_scores["global_step"].append(global_step)
-                        training_progress_scores["train_loss"].append(current_loss)
+                        training_progress_scores["global_step"][
+                            num_scores
+                        ] = global_step
+                        training_progress_scores["train_loss"][
+                            num_scores
+                        ] = current_loss.item()
                         for key in results:
-                            training_progress_scores[key].append(results[key])
-                        report = pd.DataFrame(training_progress_scores)
-                        report.to_csv(
-                            os.path.join(
-                                args.output_dir, "training_progress_scores.csv"
-                            ),
-                            index=False,
+                            training_progress_scores[key][num_scores] = results[key]
+                        num_scores += 1
+                        last_metrics = self._get_last_metrics(
+                            training_progress_scores, num_scores
                         )
+                        if is_world_master:
+                            with open(
+                                training_progress_scores_file, "a", newline=""
+                            ) as f:
+                                csv.writer(f).writerow(last_metrics.values())
 
-                        if args.wandb_project or self.is_sweeping:
-                            wandb.log(self._get_last_metrics(training_progress_scores))
+                            if args.wandb_project or self.is_sweeping:
+                                wandb.log(last_metrics)
 
                         if not best_eval_metric:
                             best_eval_metric = results[args.early_stopping_metric]
@@ -674,9 +766,11 @@ class ConvAIModel:
                                             train_iterator.close()
                                         return (
                                             global_step,
-                                            tr_loss / global_step
+                                            tr_loss.item() / global_step
                                             if not self.args.evaluate_during_training
-                                            else training_progress_scores,
+                                            else self._get_training_progress_scores(
+                                                training_progress_scores, num_scores
+                                            ),
                                         )
                         else:
                             if (
@@ -714,9 +808,11 @@ class ConvAIModel:
                                             train_iterator.close()
                                         return (
                                             global_step,
-                                            tr_loss / global_step
+                                            tr_loss.item() / global_step
                                             if not self.args.evaluate_during_training
-                                            else training_progress_scores,
+                                            else self._get_training_progress_scores(
+                                                training_progress_scores, num_scores
+                                            ),
                                         )
 
             epoch_number += 1
@@ -724,7 +820,9 @@ class ConvAIModel:
                 output_dir, "checkpoint-{}-epoch-{}".format(global_step, epoch_number)
             )
 
-            if args.save_model_every_epoch or args.evaluate_during_training:
+            if (
+                args.save_model_every_epoch or args.evaluate_during_training
+            ) and is_world_master:
                 os.makedirs(output_dir_current, exist_ok=True)
 
             if args.save_model_every_epoch:
@@ -740,18 +838,20 @@ class ConvAIModel:
 
                 self.save_model(output_dir_current, results=results)
 
-                training_progress_scores["global_step"].append(global_step)
-                training_progress_scores["train_loss"].append(current_loss)
+                training_progress_scores["global_step"][num_scores] = global_step
+                training_progress_scores["train_loss"][num_scores] = current_loss.item()
                 for key in results:
-                    training_progress_scores[key].append(results[key])
-                report = pd.DataFrame(training_progress_scores)
-                report.to_csv(
-                    os.path.join(args.output_dir, "training_progress_scores.csv"),
-                    index=False,
+                    training_progress_scores[key][num_scores] = results[key]
+                num_scores += 1
+                last_metrics = self._get_last_metrics(
+                    training_progress_scores, num_scores
                 )
+                if is_world_master:
+                    with open(training_progress_scores_file, "a", newline="") as f:
+                        csv.writer(f).writerow(last_metrics.values())
 
-                if args.wandb_project or self.is_sweeping:
-                    wandb.log(self._get_last_metrics(training_progress_scores))
+                    if args.wandb_project or self.is_sweeping:
+                        wandb.log(last_metrics)
 
                 if not best_eval_metric:
                     best_eval_metric = results[args.early_stopping_metric]
@@ -780,9 +880,11 @@ class ConvAIModel:
 
         return (
             global_step,
-            tr_loss / global_step
+            tr_loss.item() / global_step
             if not self.args.evaluate_during_training
-            else training_progress_scores,
+            else self._get_training_progress_scores(
+                training_progress_scores, num_scores
+            ),
         )
 
     def eval_model(
@@ -825,6 +927,8 @@ class ConvAIModel:
 
         Utility function to be used by the eval_model() method. Not intended to be used directly.
         """
+        from sklearn.metrics import f1_score
+
         device = self.device
         model = self.model
         args = self.args
@@ -841,64 +945,57 @@ class ConvAIModel:
 
         nb_eval_steps = 0
         loss_fct = torch.nn.CrossEntropyLoss(ignore_index=-100)
-        results = {
-            "language_model_loss": [],
-            "f1_score": [],
-        }
+        all_lm_losses = []
+        all_mc_preds = []
+        all_mc_labels = []
         model.eval()
+        model = self._compile_model(model)
 
-        if args.n_gpu > 1:
+        # In distributed runs each process evaluates on its own device
+        if args.n_gpu > 1 and args.local_rank == -1:
             model = torch.nn.DataParallel(model)
 
-        if args.fp16:
-            from torch.cuda import amp
-
-        for batch in tqdm(
+        eval_batches = tqdm(
             eval_dataloader, disable=args.silent or silent, desc="Running Evaluation"
-        ):
-            batch = tuple(t.to(device) for t in batch)
-
-            with torch.no_grad():
+        )
+        with torch.inference_mode(), self._get_autocast():
+            for batch in prefetch_to_device(eval_batches, device):
                 input_ids, mc_token_ids, labels, mc_labels, token_type_ids = batch
 
-                if args.fp16:
-                    with amp.autocast():
-                        outputs = model(
-                            input_ids,
-                            token_type_ids=token_type_ids,
-                            mc_token_ids=mc_token_ids,
-                        )
-                        lm_logits, mc_logits = outputs[:2]
-                else:
-                    outputs = model(
-                        input_ids,
-                        token_type_ids=token_type_ids,
-                        mc_token_ids=mc_token_ids,
-                    )
-                    lm_logits, mc_logits = outputs[:2]
+                outputs = model(
+                    input_ids,
+                    token_type_ids=token_type_ids,
+                    mc_token_ids=mc_token_ids,
+                )
+                lm_logits, mc_logits = outputs[:2]
                 # model outputs are always tuple in pytorch-transformers (see doc)
 
-                lm_logits_flat_shifted = (
-                    lm_logits[..., :-1, :].contiguous().view(-1, lm_logits.size(-1))
+                lm_logits_flat_shifted = lm_logits[..., :-1, :].reshape(
+                    -1, lm_logits.size(-1)
                 )
-                labels_flat_shifted = labels[..., 1:].contiguous().view(-1)
+                labels_flat_shifted = labels[..., 1:].reshape(-1)
 
-            nb_eval_steps += 1
+                nb_eval_steps += 1
 
-            mc_logits = [np.argmax(pred) for pred in mc_logits.cpu().numpy()]
-            f1_current = f1_score(mc_labels.cpu().numpy(), mc_logits, average="macro")
-            lm_loss_current = loss_fct(lm_logits_flat_shifted, labels_flat_shifted)
+                lm_loss_current = loss_fct(lm_logits_flat_shifted, labels_flat_shifted)
 
-            results["language_model_loss"].append(lm_loss_current.cpu().numpy().item())
-            results["f1_score"].append(f1_current)
+                # Kept on the device so that there is only one sync after the loop
+                all_lm_losses.append(lm_loss_current.detach())
+                all_mc_preds.append(mc_logits.argmax(dim=-1))
+                all_mc_labels.append(mc_labels)
 
-        results["language_model_loss"] = statistics.mean(results["language_model_loss"])
-        results["f1_score"] = statistics.mean(results["f1_score"])
+        mc_preds = torch.cat(all_mc_preds).cpu().numpy()
+        mc_labels = torch.cat(all_mc_labels).cpu().numpy()
+        results = {
+            "language_model_loss": torch.stack(all_lm_losses).mean().item(),
+            "f1_score": f1_score(mc_labels, mc_preds, average="macro"),
+        }
 
-        output_eval_file = os.path.join(eval_output_dir, "eval_results.txt")
-        with open(output_eval_file, "w") as writer:
-            for key in sorted(results.keys()):
-                writer.write("{} = {}\n".format(key, str(results[key])))
+        if self.is_world_master():
+            output_eval_file = os.path.join(eval_output_dir, "eval_results.txt")
+            with open(output_eval_file, "w") as writer:
+                for key in sorted(results.keys()):
+                    writer.write("{} = {}\n".format(key, str(results[key])))
 
         return results
 
@@ -945,52 +1042,66 @@ class ConvAIModel:
         num_candidates = len(dataset[0]["utterances"][0]["candidates"])
         if args.num_candidates > 0 and not evaluate:
             num_candidates = min(args.num_candidates, num_candidates)
-        for dialog in dataset:
-            persona = dialog["personality"].copy()
-            for _ in range(args.personality_permutations):
-                for utterance in dialog["utterances"]:
-                    history = utterance["history"][-(2 * args.max_history + 1) :]
-                    for j, candidate in enumerate(
-                        utterance["candidates"][-num_candidates:]
-                    ):
-                        labels = bool(j == num_candidates - 1)
-                        instance = self.build_input_from_segments(
-                            persona, history, candidate, tokenizer, labels
-                        )
-                        for input_name, input_array in instance.items():
-                            datasets[input_name].append(input_array)
-                    datasets["mc_labels"].append(num_candidates - 1)
-                    datasets["n_candidates"] = num_candidates
-                persona = [persona[-1]] + persona[:-1]  # permuted personalities
-
-        # logger.info(" Pad inputs and convert to Tensor")
-        # tensor_datasets = {"train": [], "valid": []}
-        # for dataset_name, dataset in datasets.items():
-        tensor_datasets = []
-        dataset = self.pad_dataset(
-            datasets, padding=tokenizer.convert_tokens_to_ids(SPECIAL_TOKENS[-1])
+
+        build_instances = partial(
+            build_dialog_instances,
+            num_candidates=num_candidates,
+            max_history=args.max_history,
+            personality_permutations=args.personality_permutations,
+            special_token_ids=self._special_token_ids,
         )
-        for input_name in MODEL_INPUTS:
-            tensor = torch.tensor(dataset[input_name])
-            if input_name != "mc_labels":
-                tensor = tensor.view((-1, datasets["n_candidates"]) + tensor.shape[1:])
-            tensor_datasets.append(tensor)
-
-        # logger.info(" Build train and validation dataloaders")
-        # train_dataset, valid_dataset = (
-        #     TensorDataset(*tensor_datasets["train"]),
-        #     TensorDataset(*tensor_datasets["valid"]),
-        # )
-        tensor_dataset = TensorDataset(*tensor_datasets)
+        if (not evaluate and args.use_multiprocessing) or (
+            evaluate and args.use_multiprocessing_for_evaluation
+        ):
+            if args.multiprocessing_chunksize == -1:
+                chunksize = max(len(dataset) // (process_count * 2), 1)
+            else:
+                chunksize = args.multiprocessing_chunksize
+
+            with Pool(process_count) as p:
+                for instances in tqdm(
+                    p.imap(build_instances, dataset, chunksize=chunksize),
+                    total=len(dataset),
+                    disable=args.silent or silent,
+                ):
+                    for input_name, input_arrays in instances.items():
+                        datasets[input_name].extend(input_arrays)
+        else:
+            for dialog in tqdm(dataset, disable=args.silent or silent):
+                for input_name, input_arrays in build_instances(dialog).items():
+                    datasets[input_name].extend(input_arrays)
+
+        # Inputs are padded to the longest sequence in each batch rather than in the dataset
+        conv_ai_dataset = ConvAIDataset(datasets, num_candidates)
+        dataloader_kwargs = {
+            "collate_fn": partial(pad_collate, padding=self._special_token_ids[-1]),
+            "num_workers": args.dataloader_num_workers,
+            # Page-locked batches can be copied to the GPU asynchronously
+            "pin_memory": args.dataloader_pin_memory and self.device != "cpu",
+        }
+        if args.dataloader_num_workers > 0:
+            # Keep the workers alive between epochs and have them prepare batches ahead
+            dataloader_kwargs["persistent_workers"] = True
+            dataloader_kwargs["prefetch_factor"] = args.dataloader_prefetch_factor
         if not evaluate:
-            data_sampler = RandomSampler(tensor_dataset)
+            data_sampler = (
+                RandomSampler(conv_ai_dataset)
+                if args.local_rank == -1
+                else DistributedSampler(conv_ai_dataset)
+            )
             data_loader = DataLoader(
-                tensor_dataset, sampler=data_sampler, batch_size=args.train_batch_size
+                conv_ai_dataset,
+                sampler=data_sampler,
+                batch_size=args.train_batch_size,
+                **dataloader_kwargs,
             )
         else:
-            data_sampler = SequentialSampler(tensor_dataset)
+            data_sampler = SequentialSampler(conv_ai_dataset)
             data_loader = DataLoader(
-                tensor_dataset, sampler=data_sampler, batch_size=args.eval_batch_size
+                conv_ai_dataset,
+                sampler=data_sampler,
+                batch_size=args.eval_batch_size,
+                **dataloader_kwargs,
             )
 
         # logger.info(" Train dataset (Batch, Candidates, Seq length): {}".format(train_dataset.tensors[0].shape))
@@ -1014,6 +1125,8 @@ class ConvAIModel:
             result: Dictionary containing evaluation results. (f1_score, language_model_loss)
         """  # noqa: ignore flake8"
 
+        from sklearn.metrics import f1_score
+
         loss_fct = torch.nn.CrossEntropyLoss(ignore_index=-100)
         extra_metrics = {}
         for metric, func in kwargs.items():
@@ -1043,33 +1156,34 @@ class ConvAIModel:
         tokenizer = self.tokenizer
         process_count = self.args.process_count
 
-        if self.args.fp16:
-            from torch.cuda import amp
-
         self._move_model_to_device()
+        model = self._compile_model(model)
 
         if self.args.model_type in ["blender", "blender-small"]:
             if not personality:
                 personality = []
         else:
             if not personality:
-                dataset = get_dataset(
-                    tokenizer,
-                    None,
-                    args.cache_dir,
-                    process_count=process_count,
-                    proxies=self.__dict__.get("proxies", None),
-                    interact=True,
-                    args=args,
-                )
-                personalities = [
-                    dialog["personality"]
-                    for dataset in dataset.values()
-                    for dialog in dataset
-                ]
-                personality = random.choice(personalities)
+                if self._cached_personalities is None:
+                    dataset = get_dataset(
+                        tokenizer,
+                        None,
+                        args.cache_dir,
+                        process_count=process_count,
+                        proxies=self.__dict__.get("proxies", None),
+                        interact=True,
+                        args=args,
+                    )
+                    self._cached_personalities = [
+                        dialog["personality"]
+                        for dataset in dataset.values()
+                        for dialog in dataset
+                    ]
+                personality = random.choice(self._cached_personalities)
             else:
-                personality = [tokenizer.encode(s.lower()) for s in personality]
+                personality = tokenizer(
+                    [s.lower() for s in personality], add_special_tokens=False
+                )["input_ids"]
 
         history = []
         while True:
@@ -1078,20 +1192,14 @@ class ConvAIModel:
                 print("Prompt should not be empty!")
                 raw_text = input(">>> ")
             history.append(
-                tokenizer.encode(raw_text)
+                tokenizer(raw_text, add_special_tokens=False)["input_ids"]
                 if self.args.model_type not in ["blender", "blender-small"]
                 else raw_text
             )
-            with torch.no_grad():
-                if args.fp16:
-                    with amp.autocast():
-                        out_ids = self.sample_sequence(
-                            personality, history, tokenizer, model, args
-                        )
-                else:
-                    out_ids = self.sample_sequence(
-                        personality, history, tokenizer, model, args
-                    )
+            with torch.inference_mode(), self._get_autocast():
+                out_ids = self.sample_sequence(
+                    personality, history, tokenizer, model, args
+                )
             history.append(out_ids)
             history = history[-(2 * args.max_history + 1) :]
             if self.args.model_type in ["blender", "blender-small"]:
@@ -1124,44 +1232,42 @@ class ConvAIModel:
         tokenizer = self.tokenizer
         process_count = self.args.process_count
 
-        if self.args.fp16:
-            from torch.cuda import amp
-
         self._move_model_to_device()
+        model = self._compile_model(model)
 
         if not personality:
-            dataset = get_dataset(
-                tokenizer,
-                None,
-                args.cache_dir,
-                process_count=process_count,
-                proxies=self.__dict__.get("proxies", None),
-                interact=True,
-            )
-            personalities = [
-                dialog["personality"]
-                for dataset in dataset.values()
-                for dialog in dataset
-            ]
-            personality = random.choice(personalities)
+            if self._cached_personalities is None:
+                dataset = get_dataset(
+                    tokenizer,
+                    None,
+                    args.cache_dir,
+                    process_count=process_count,
+                    proxies=self.__dict__.get("proxies", None),
+                    interact=True,
+                    args=args,
+                )
+                self._cached_personalities = [
+                    dialog["personality"]
+                    for dataset in dataset.values()
+                    for dialog in dataset
+                ]
+            personality = random.choice(self._cached_personalities)
         else:
-            personality = [tokenizer.encode(s.lower()) for s in personality]
+            personality = tokenizer(
+                [s.lower() for s in personality], add_special_tokens=False
+            )["input_ids"]
 
         if encode_history:
             raw_history = history.copy()
             raw_history.append(message)
-            history = [tokenizer.encode(sentence) for sentence in history]
-        history.append(tokenizer.encode(message))
-        with torch.no_grad():
-            if args.fp16:
-                with amp.autocast():
-                    out_ids = self.sample_sequence(
-                        personality, history, tokenizer, model, args
-                    )
-            else:
-                out_ids = self.sample_sequence(
-                    personality, history, tokenizer, model, args
-                )
+            history = (
+                tokenizer(history, add_special_tokens=False)["input_ids"]
+                if history
+                else []
+            )
+        history.append(tokenizer(message, add_special_tokens=False)["input_ids"])
+        with torch.inference_mode(), self._get_autocast():
+            out_ids = self.sample_sequence(personality, history, tokenizer, model, args)
         out_text = tokenizer.decode(
             out_ids, skip_special_tokens=self.args.skip_special_tokens
         )
@@ -1182,26 +1288,69 @@ class ConvAIModel:
     def _move_model_to_device(self):
         self.model.to(self.device)
 
+    def _use_bf16(self):
+        """Return True if bf16 is enabled and supported by the device."""
+        return (
+            self.args.bf16 and self.device != "cpu" and torch.cuda.is_bf16_supported()
+        )
+
+    def _get_autocast(self, use_bf16=None):
+        """
+        Return the autocast context used for training, evaluation and generation.
+        use_bf16 can be passed in to skip the bf16 device check when it is already known.
+        """
+        if use_bf16 is None:
+            use_bf16 = self._use_bf16()
+        return amp.autocast(
+            enabled=self.args.fp16 or use_bf16,
+            dtype=torch.bfloat16 if use_bf16 else torch.float16,
+        )
+
+    def _compile_model(self, model):
+        """Compile the model with torch.compile if args.torch_compile is set."""
+        if self.args.torch_compile:
+            if hasattr(torch, "compile"):
+                # Compiled graphs are cached per module, so repeated calls are cheap
+                return torch.compile(model, mode=self.args.torch_compile_mode)
+            warnings.warn(
+                "torch_compile requires PyTorch 2.0 or later. torch_compile disabled."
+            )
+            self.args.torch_compile = False
+        return model
+
     # def _get_inputs_dict(self, batch):
     #     input_ids, mc_token_ids, labels, mc_labels, token_type_ids = batch
 
     #     return input_ids, mc_token_ids, labels, mc_labels, token_type_ids
 
-    def _get_last_metrics(self, metric_values):
-        return {metric: values[-1] for metric, values in metric_values.items()}
+    def _get_last_metrics(self, metric_values, num_scores):
+        return {
+            metric: values[num_scores - 1].item()
+            for metric, values in metric_values.items()
+        }
+
+    def _get_training_progress_scores(self, metric_values, num_scores):
+        return {
+            metric: values[:num_scores].tolist()
+            for metric, values in metric_values.items()
+        }
 
-    def _create_training_progress_scores(self, **kwargs):
-        extra_metrics = {key: [] for key in kwargs}
+    def _create_training_progress_scores(self, num_evaluations, **kwargs):
+        """Preallocate the score arrays so that each evaluation is written in place."""
+        extra_metrics = {key: np.full(num_evaluations, np.nan) for key in kwargs}
         training_progress_scores = {
-            "global_step": [],
-            "language_model_loss": [],
-            "f1_score": [],
+            "global_step": np.zeros(num_evaluations, dtype=np.int64),
+            "train_loss": np.full(num_evaluations, np.nan),
+            "language_model_loss": np.full(num_evaluations, np.nan),
+            "f1_score": np.full(num_evaluations, np.nan),
             **extra_metrics,
         }
 
         return training_progress_scores
 
     def save_model(self, output_dir=None, model=None, results=None):
+        if not self.is_world_master():
+            return
         if not output_dir:
             output_dir = self.args.output_dir
 
@@ -1220,12 +1369,12 @@ class ConvAIModel:
 
     def add_special_tokens_(self, model, tokenizer):
         """Add special tokens to the tokenizer and the model if they have not already been added."""
-        orig_num_tokens = len(tokenizer.encoder)
+        orig_num_tokens = tokenizer.vocab_size
         num_added_tokens = tokenizer.add_special_tokens(
             ATTR_TO_SPECIAL_TOKEN
         )  # doesn't add if they are already there
         if num_added_tokens > 0:
-            self.model.resize_token_embeddings(
+            model.resize_token_embeddings(
                 new_num_tokens=orig_num_tokens + num_added_tokens
             )
 
@@ -1233,43 +1382,14 @@ class ConvAIModel:
         self, persona, history, reply, tokenizer, labels=False, with_eos=True
     ):
         """Build a sequence of input from 3 segments: persona, history and last reply."""
-        bos, eos, speaker1, speaker2 = tokenizer.convert_tokens_to_ids(
-            SPECIAL_TOKENS[:-1]
+        return build_input_from_segments(
+            persona,
+            history,
+            reply,
+            self._special_token_ids,
+            labels=labels,
+            with_eos=with_eos,
         )
-        sequence = (
-            [[bos] + list(chain(*persona))]
-            + history
-            + [reply + ([eos] if with_eos else [])]
-        )
-        sequence = [sequence[0]] + [
-            [speaker2 if (len(sequence) - i) % 2 else speaker1] + s
-            for i, s in enumerate(sequence[1:])
-        ]
-        instance = {}
-        instance["input_ids"] = list(chain(*sequence))
-        instance["token_type_ids"] = [
-            speaker2 if i % 2 else speaker1 for i, s in enumerate(sequence) for _ in s
-        ]
-        instance["mc_token_ids"] = len(instance["input_ids"]) - 1
-        instance["labels"] = [-100] * len(instance["input_ids"])
-        if labels:
-            instance["labels"] = (
-                ([-100] * sum(len(s) for s in sequence[:-1]))
-                + [-100]
-                + sequence[-1][1:]
-            )
-        return instance
-
-    def pad_dataset(self, dataset, padding=0):
-        """Pad the dataset. This could be optimized by defining a Dataset class and padding at the batch level,
-        but this is simpler."""
-        max_l = max(len(x) for x in dataset["input_ids"])
-        for name in PADDED_INPUTS:
-            dataset[name] = [
-                x + [padding if name != "labels" else -100] * (max_l - len(x))
-                for x in dataset[name]
-            ]
-        return dataset
 
     def top_filtering(
         self,
@@ -1294,24 +1414,28 @@ class ConvAIModel:
         )  # Only work for batch size 1 for now - could update but it would obfuscate a bit the code
         top_k = min(top_k, logits.size(-1))
         if top_k > 0:
-            # Remove all tokens with a probability less than the last token in the top-k tokens
-            indices_to_remove = logits < torch.topk(logits, top_k)[0][..., -1, None]
-            logits[indices_to_remove] = filter_value
+            # Keep only the top-k tokens. The mask is built from the top-k indices rather than
+            # the k-th value so that tokens tied with it do not also survive.
+            top_k_logits, top_k_indices = torch.topk(logits, top_k)
+            logits = torch.full_like(logits, filter_value).scatter_(
+                -1, top_k_indices, top_k_logits
+            )
 
         if top_p > 0.0:
-            # Compute cumulative probabilities of sorted tokens
-            sorted_logits, sorted_indices = torch.sort(logits, descending=True)
-            cumulative_probabilities = torch.cumsum(
-                F.softmax(sorted_logits, dim=-1), dim=-1
-            )
+            # Compute cumulative probabilities of sorted tokens. After top-k filtering, only the
+            # top-k tokens (already sorted by torch.topk) need to be considered.
+            if top_k > 0:
+                sorted_logits, sorted_indices = top_k_logits, top_k_indices
+            else:
+                sorted_logits, sorted_indices = torch.sort(logits, descending=True)
+            sorted_probabilities = F.softmax(sorted_logits, dim=-1)
+            cumulative_probabilities = torch.cumsum(sorted_probabilities, dim=-1)
 
-            # Remove tokens with cumulative probability above the threshold
-            sorted_indices_to_remove = cumulative_probabilities > top_p
-            # Shift the indices to the right to keep also the first token above the threshold
-            sorted_indices_to_remove[..., 1:] = sorted_indices_to_remove[
-                ..., :-1
-            ].clone()
-            sorted_indices_to_remove[..., 0] = 0
+            # Remove tokens with cumulative probability above the threshold. The probability mass
+            # before each token is compared so that the first token above the threshold is kept.
+            sorted_indices_to_remove = (
+                cumulative_probabilities - sorted_probabilities
+            ) > top_p
 
             # Back to unsorted indices and set them to -infinity
             indices_to_remove = sorted_indices[sorted_indices_to_remove]
@@ -1345,23 +1469,38 @@ class ConvAIModel:
                 reply[0][10:-8] if self.args.model_type == "blender-small" else reply[0]
             )  # To remove the "__start__ " and " __end__"
         else:
-            special_tokens_ids = tokenizer.convert_tokens_to_ids(SPECIAL_TOKENS)
+            special_tokens_ids = set(self._special_token_ids)
             if current_output is None:
                 current_output = []
 
-            for i in range(args.max_length):
-                instance = self.build_input_from_segments(
-                    personality, history, current_output, tokenizer, with_eos=False
-                )
+            # GPT-2 can reuse the attention keys/values of the prefix, so only the prompt is
+            # encoded in full and every later step feeds just the newly generated token.
+            # OpenAI GPT has no cache, so the generated token is appended to the full sequence.
+            use_cache = args.model_type == "gpt2"
+            past_key_values = None
 
-                input_ids = torch.tensor(
-                    instance["input_ids"], device=self.device
-                ).unsqueeze(0)
-                token_type_ids = torch.tensor(
-                    instance["token_type_ids"], device=self.device
-                ).unsqueeze(0)
+            instance = self.build_input_from_segments(
+                personality, history, current_output, tokenizer, with_eos=False
+            )
+            input_ids = torch.tensor(instance["input_ids"], device=self.device).unsqueeze(0)
+            token_type_ids = torch.tensor(
+                instance["token_type_ids"], device=self.device
+            ).unsqueeze(0)
+            # Generated tokens continue the reply segment, which ends the prompt
+            reply_token_type_ids = token_type_ids[:, -1:]
 
-                logits = model(input_ids, token_type_ids=token_type_ids)
+            for i in range(args.max_length):
+                if use_cache:
+                    # use_cache is passed explicitly as gradient checkpointing disables it in the config
+                    logits = model(
+                        input_ids,
+                        token_type_ids=token_type_ids,
+                        past_key_values=past_key_values,
+                        use_cache=True,
+                    )
+                    past_key_values = logits.past_key_values
+                else:
+                    logits = model(input_ids, token_type_ids=token_type_ids)
                 if args.model_type in ["gpt2", "gpt"]:  # for gpt2 and maybe others
                     logits = logits[0]
                 logits = logits[0, -1, :] / args.temperature
@@ -1369,22 +1508,34 @@ class ConvAIModel:
                 probs = F.softmax(logits, dim=-1)
 
                 prev = (
-                    torch.topk(probs, 1)[1]
+                    torch.argmax(probs, dim=-1, keepdim=True)
                     if not args.do_sample
                     else torch.multinomial(probs, 1)
                 )
-                if i < args.min_length and prev.item() in special_tokens_ids:
-                    while prev.item() in special_tokens_ids:
+                # Read the sampled token back from the device once per step
+                prev_id = prev.item()
+                if i < args.min_length and prev_id in special_tokens_ids:
+                    while prev_id in special_tokens_ids:
                         if probs.max().item() == 1:
                             warnings.warn(
                                 "Warning: model generating special token with probability 1."
                             )
                             break  # avoid infinitely looping over special token
                         prev = torch.multinomial(probs, num_samples=1)
+                        prev_id = prev.item()
 
-                if prev.item() in special_tokens_ids:
+                if prev_id in special_tokens_ids:
                     break
-                current_output.append(prev.item())
+                current_output.append(prev_id)
+
+                if use_cache:
+                    input_ids = prev.view(1, 1)
+                    token_type_ids = reply_token_type_ids
+                else:
+                    input_ids = torch.cat((input_ids, prev.view(1, 1)), dim=1)
+                    token_type_ids = torch.cat(
+                        (token_type_ids, reply_token_type_ids), dim=1
+                    )
 
         return current_output
 
@@ -1397,5 +1548,12 @@ class ConvAIModel:
         args.load(input_dir)
         return args
 
+    def is_world_master(self) -> bool:
+        """
+        This will be True only in one process, even in distributed mode,
+        even when training on multiple machines.
+        """
+        return self.args.local_rank == -1 or torch.distributed.get_rank() == 0
+
     def get_named_parameters(self):
         return [n for n, p in self.model.named_parameters()]
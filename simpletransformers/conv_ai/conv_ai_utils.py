@@ -7,18 +7,30 @@ import os
 import socket
 import tarfile
 import tempfile
+from collections import defaultdict
 from datetime import datetime
+from itertools import chain
 from multiprocessing import Pool
 
+import numpy as np
 import torch
+from torch.utils.data import Dataset
 from tqdm.auto import tqdm
 from transformers import cached_path
 
+try:
+    from transformers.pytorch_utils import Conv1D
+except ImportError:
+    from transformers.modeling_utils import Conv1D
+
 PERSONACHAT_URL = "https://s3.amazonaws.com/datasets.huggingface.co/personachat/personachat_self_original.json"
 HF_FINETUNED_MODEL = "https://s3.amazonaws.com/models.huggingface.co/transfer-learning-chatbot/gpt_personachat_cache.tar.gz"  # noqa
 
 logger = logging.getLogger(__file__)
 
+MODEL_INPUTS = ["input_ids", "mc_token_ids", "labels", "mc_labels", "token_type_ids"]
+PADDED_INPUTS = ["input_ids", "labels", "token_type_ids"]
+
 
 def download_pretrained_model():
     """Download and extract finetuned model from S3"""
@@ -34,6 +46,186 @@ def download_pretrained_model():
     return tempdir
 
 
+def convert_conv1d_to_linear(model):
+    """
+    Replace the GPT/GPT-2 Conv1D projections with equivalent nn.Linear layers.
+    Conv1D stores its weight transposed and is skipped by torch dynamic quantization.
+    """
+    conv1d_layers = [
+        (parent, name, child)
+        for parent in model.modules()
+        for name, child in parent.named_children()
+        if isinstance(child, Conv1D)
+    ]
+    for parent, name, conv1d in conv1d_layers:
+        in_features, out_features = conv1d.weight.shape
+        linear = torch.nn.Linear(in_features, out_features)
+        linear.weight.data = conv1d.weight.data.t().contiguous()
+        linear.bias.data = conv1d.bias.data
+        setattr(parent, name, linear)
+    return model
+
+
+def prefetch_to_device(batches, device):
+    """
+    Yield each batch of tensors moved to device. On CUDA devices, the copy of the next batch is
+    issued on a separate stream so that it overlaps with the computation on the current batch.
+    """
+    if torch.device(device).type != "cuda":
+        for batch in batches:
+            yield tuple(t.to(device) for t in batch)
+        return
+
+    copy_stream = torch.cuda.Stream(device=device)
+
+    def copy_to_device(batch):
+        with torch.cuda.stream(copy_stream):
+            return tuple(t.to(device, non_blocking=True) for t in batch)
+
+    next_batch = None
+    for batch in batches:
+        batch = copy_to_device(batch)
+        if next_batch is not None:
+            yield next_batch
+        torch.cuda.current_stream(device).wait_stream(copy_stream)
+        for t in batch:
+            # The memory was allocated on copy_stream but will be used on the current stream
+            t.record_stream(torch.cuda.current_stream(device))
+        next_batch = batch
+
+    if next_batch is not None:
+        yield next_batch
+
+
+def build_input_from_segments(
+    persona, history, reply, special_token_ids, labels=False, with_eos=True
+):
+    """Build a sequence of input from 3 segments: persona, history and last reply."""
+    bos, eos, speaker1, speaker2 = special_token_ids[:-1]
+    sequence = (
+        [[bos] + list(chain.from_iterable(persona))]
+        + history
+        + [reply + ([eos] if with_eos else [])]
+    )
+    sequence = [sequence[0]] + [
+        [speaker2 if (len(sequence) - i) % 2 else speaker1] + s
+        for i, s in enumerate(sequence[1:])
+    ]
+    instance = {}
+    instance["input_ids"] = list(chain.from_iterable(sequence))
+    # Build the token type ids one segment at a time rather than one token at a time
+    token_type_ids = []
+    for i, s in enumerate(sequence):
+        token_type_ids.extend([speaker2 if i % 2 else speaker1] * len(s))
+    instance["token_type_ids"] = token_type_ids
+    instance["mc_token_ids"] = len(instance["input_ids"]) - 1
+    instance["labels"] = [-100] * len(instance["input_ids"])
+    if labels:
+        instance["labels"] = (
+            ([-100] * sum(len(s) for s in sequence[:-1])) + [-100] + sequence[-1][1:]
+        )
+    return instance
+
+
+def build_dialog_instances(
+    dialog, num_candidates, max_history, personality_permutations, special_token_ids
+):
+    """Build the model inputs for every candidate reply of every utterance in a dialog."""
+    instances = defaultdict(list)
+    persona = dialog["personality"].copy()
+    # Loop invariants are bound to locals as this runs for every utterance in the corpus
+    hist_window = 2 * max_history + 1
+    last_cand_idx = num_candidates - 1
+    build = build_input_from_segments
+    for _ in range(personality_permutations):
+        for utterance in dialog["utterances"]:
+            history = utterance["history"][-hist_window:]
+            for j, candidate in enumerate(utterance["candidates"][-num_candidates:]):
+                instance = build(
+                    persona, history, candidate, special_token_ids, j == last_cand_idx
+                )
+                for input_name, input_array in instance.items():
+                    instances[input_name].append(input_array)
+            instances["mc_labels"].append(last_cand_idx)
+        persona = [persona[-1]] + persona[:-1]  # permuted personalities
+    return instances
+
+
+class ConvAIDataset(Dataset):
+    def __init__(self, datasets, num_candidates):
+        # Each example holds the (unpadded) inputs for all the candidate replies of an utterance.
+        # The sequences are stored as flat int64 arrays with row offsets rather than lists of
+        # ints, so that DataLoader workers do not copy the corpus by touching refcounts.
+        self.num_candidates = num_candidates
+        lengths = np.fromiter(
+            (len(x) for x in datasets["input_ids"]),
+            dtype=np.int64,
+            count=len(datasets["input_ids"]),
+        )
+        self.offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=self.offsets[1:])
+        self.datasets = {
+            input_name: np.fromiter(
+                chain.from_iterable(datasets[input_name]),
+                dtype=np.int64,
+                count=int(self.offsets[-1]),
+            )
+            for input_name in PADDED_INPUTS
+        }
+        self.datasets["mc_token_ids"] = np.asarray(
+            datasets["mc_token_ids"], dtype=np.int64
+        )
+        self.datasets["mc_labels"] = np.asarray(datasets["mc_labels"], dtype=np.int64)
+
+    def __len__(self):
+        return len(self.datasets["mc_labels"])
+
+    def __getitem__(self, index):
+        start = index * self.num_candidates
+        end = start + self.num_candidates
+        example = []
+        for input_name in MODEL_INPUTS:
+            if input_name == "mc_labels":
+                example.append(self.datasets[input_name][index])
+            elif input_name == "mc_token_ids":
+                example.append(self.datasets[input_name][start:end])
+            else:
+                flat = self.datasets[input_name]
+                example.append(
+                    [
+                        flat[self.offsets[i] : self.offsets[i + 1]]
+                        for i in range(start, end)
+                    ]
+                )
+        return tuple(example)
+
+
+def pad_collate(batch, padding=0):
+    """Pad the sequence inputs in a batch of ConvAIDataset examples to the longest one."""
+    max_l = max(len(x) for example in batch for x in example[0])
+    num_candidates = len(batch[0][0])
+    tensors = []
+    for i, input_name in enumerate(MODEL_INPUTS):
+        if input_name in PADDED_INPUTS:
+            padded = np.full(
+                (len(batch), num_candidates, max_l),
+                padding if input_name != "labels" else -100,
+                dtype=np.int64,
+            )
+            for j, example in enumerate(batch):
+                for k, x in enumerate(example[i]):
+                    padded[j, k, : len(x)] = x
+            tensors.append(torch.from_numpy(padded))
+        else:
+            # mc_token_ids and mc_labels go through NumPy as int64 too, like the padded inputs
+            tensors.append(
+                torch.from_numpy(
+                    np.array([example[i] for example in batch], dtype=np.int64)
+                )
+            )
+    return tuple(tensors)
+
+
 def tokenize_multi(data):
     obj, tokenizer = data
     if isinstance(obj, str):
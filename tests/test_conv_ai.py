@@ -0,0 +1,220 @@
+import copy
+
+import pytest
+import torch
+import torch.nn.functional as F
+from transformers import GPT2Config, GPT2DoubleHeadsModel
+
+from simpletransformers.conv_ai import ConvAIArgs, ConvAIModel
+from simpletransformers.conv_ai.conv_ai_utils import (
+    ConvAIDataset,
+    build_dialog_instances,
+    build_input_from_segments,
+    convert_conv1d_to_linear,
+    pad_collate,
+)
+
+# bos, eos, speaker1, speaker2, pad
+SPECIAL_TOKEN_IDS = [1, 2, 3, 4, 0]
+
+
+def baseline_top_filtering(
+    logits, top_k=0, top_p=0.0, threshold=-float("Inf"), filter_value=-float("Inf")
+):
+    top_k = min(top_k, logits.size(-1))
+    if top_k > 0:
+        indices_to_remove = logits < torch.topk(logits, top_k)[0][..., -1, None]
+        logits[indices_to_remove] = filter_value
+
+    if top_p > 0.0:
+        sorted_logits, sorted_indices = torch.sort(logits, descending=True)
+        cumulative_probabilities = torch.cumsum(
+            F.softmax(sorted_logits, dim=-1), dim=-1
+        )
+        sorted_indices_to_remove = cumulative_probabilities > top_p
+        sorted_indices_to_remove[..., 1:] = sorted_indices_to_remove[..., :-1].clone()
+        sorted_indices_to_remove[..., 0] = 0
+        indices_to_remove = sorted_indices[sorted_indices_to_remove]
+        logits[indices_to_remove] = filter_value
+
+    indices_to_remove = logits < threshold
+    logits[indices_to_remove] = filter_value
+
+    return logits
+
+
+def top_filtering(logits, **kwargs):
+    # top_filtering does not use any model state
+    return ConvAIModel.top_filtering(None, logits, **kwargs)
+
+
+def get_tiny_gpt2():
+    torch.manual_seed(0)
+    config = GPT2Config(
+        vocab_size=50, n_positions=32, n_embd=16, n_layer=2, n_head=2, num_labels=1
+    )
+    return GPT2DoubleHeadsModel(config).eval()
+
+
+def get_dialog_instances():
+    dialog = {
+        "personality": [[10, 11], [12]],
+        "utterances": [
+            {"history": [[20, 21]], "candidates": [[30], [31, 32]]},
+            {"history": [[20, 21], [22]], "candidates": [[33, 34, 35], [36]]},
+        ],
+    }
+    return build_dialog_instances(
+        dialog,
+        num_candidates=2,
+        max_history=1,
+        personality_permutations=1,
+        special_token_ids=SPECIAL_TOKEN_IDS,
+    )
+
+
+def test_convert_conv1d_to_linear():
+    model = get_tiny_gpt2()
+    converted = convert_conv1d_to_linear(copy.deepcopy(model)).eval()
+
+    assert not any(
+        type(module).__name__ == "Conv1D" for module in converted.modules()
+    )
+
+    input_ids = torch.randint(0, 50, (1, 2, 8))
+    with torch.no_grad():
+        expected = model(input_ids)[0]
+        actual = converted(input_ids)[0]
+
+    assert torch.allclose(expected, actual, atol=1e-5)
+
+
+def test_build_dialog_instances():
+    instances = get_dialog_instances()
+
+    assert instances["mc_labels"] == [1, 1]
+    assert len(instances["input_ids"]) == 4
+    assert instances["input_ids"][1] == [1, 10, 11, 12, 4, 20, 21, 3, 31, 32, 2]
+    assert instances["token_type_ids"][1] == [3] * 4 + [4] * 3 + [3] * 4
+    assert instances["labels"][1] == [-100] * 8 + [31, 32, 2]
+    assert instances["labels"][0] == [-100] * len(instances["input_ids"][0])
+    assert instances["mc_token_ids"][1] == 10
+
+
+def test_conv_ai_dataset():
+    instances = get_dialog_instances()
+    dataset = ConvAIDataset(instances, num_candidates=2)
+
+    assert len(dataset) == 2
+    input_ids, mc_token_ids, labels, mc_labels, token_type_ids = dataset[1]
+    assert [x.tolist() for x in input_ids] == instances["input_ids"][2:]
+    assert [x.tolist() for x in labels] == instances["labels"][2:]
+    assert [x.tolist() for x in token_type_ids] == instances["token_type_ids"][2:]
+    assert mc_token_ids.tolist() == instances["mc_token_ids"][2:]
+    assert mc_labels == 1
+
+
+def test_pad_collate():
+    instances = get_dialog_instances()
+    dataset = ConvAIDataset(instances, num_candidates=2)
+
+    input_ids, mc_token_ids, labels, mc_labels, token_type_ids = pad_collate(
+        [dataset[0], dataset[1]], padding=SPECIAL_TOKEN_IDS[-1]
+    )
+    max_l = max(len(x) for x in instances["input_ids"])
+
+    assert input_ids.shape == (2, 2, max_l)
+    assert labels.shape == (2, 2, max_l)
+    assert token_type_ids.shape == (2, 2, max_l)
+    assert mc_token_ids.shape == (2, 2)
+    assert mc_labels.tolist() == [1, 1]
+    assert input_ids.dtype == torch.int64
+
+    for i, x in enumerate(instances["input_ids"]):
+        row = input_ids[i // 2, i % 2]
+        assert row[: len(x)].tolist() == x
+        assert (row[len(x) :] == SPECIAL_TOKEN_IDS[-1]).all()
+        assert (labels[i // 2, i % 2, len(x) :] == -100).all()
+        assert (token_type_ids[i // 2, i % 2, len(x) :] == SPECIAL_TOKEN_IDS[-1]).all()
+
+
+@pytest.mark.parametrize("top_k", [0, 1, 5, 20])
+@pytest.mark.parametrize("top_p", [0.0, 0.5, 0.9])
+def test_top_filtering(top_k, top_p):
+    torch.manual_seed(0)
+    logits = torch.randn(100)
+
+    expected = baseline_top_filtering(logits.clone(), top_k=top_k, top_p=top_p)
+    actual = top_filtering(logits.clone(), top_k=top_k, top_p=top_p)
+
+    assert torch.equal(expected, actual)
+
+
+@pytest.mark.parametrize("top_p", [0.0, 0.5, 0.9])
+def test_top_filtering_ties(top_p):
+    logits = torch.tensor([5.0, 3.0, 3.0, 3.0, 1.0])
+
+    top_k_only = top_filtering(logits.clone(), top_k=2, top_p=0.0)
+    assert torch.isfinite(top_k_only).sum() == 2
+    assert top_k_only[0] == 5.0
+
+    # The nucleus step sees exactly the tokens that survive top-k filtering
+    expected = baseline_top_filtering(top_k_only.clone(), top_p=top_p)
+    actual = top_filtering(logits.clone(), top_k=2, top_p=top_p)
+
+    assert torch.equal(expected, actual)
+
+
+def full_prefix_greedy_decode(model, personality, history, max_length):
+    # Rebuilds and encodes the whole sequence at every step, as before the key/value cache
+    output = []
+    for _ in range(max_length):
+        instance = build_input_from_segments(
+            personality, history, output, SPECIAL_TOKEN_IDS, with_eos=False
+        )
+        logits = model(
+            torch.tensor([instance["input_ids"]]),
+            token_type_ids=torch.tensor([instance["token_type_ids"]]),
+            use_cache=False,
+        )[0]
+        prev = logits[0, -1].argmax().item()
+        if prev in SPECIAL_TOKEN_IDS:
+            break
+        output.append(prev)
+    return output
+
+
+@pytest.mark.parametrize("model_type", ["gpt2", "gpt"])
+def test_sample_sequence_matches_full_prefix(model_type):
+    torch.manual_seed(0)
+    config = GPT2Config(
+        vocab_size=50,
+        n_positions=32,
+        n_embd=16,
+        n_layer=2,
+        n_head=2,
+        num_labels=1,
+        tie_word_embeddings=False,
+    )
+    model = GPT2DoubleHeadsModel(config).eval()
+    with torch.no_grad():
+        # Never generate a special token so that every step of the decode is compared
+        model.lm_head.weight[SPECIAL_TOKEN_IDS] = 0.0
+
+    conv_ai_model = ConvAIModel.__new__(ConvAIModel)
+    conv_ai_model.args = ConvAIArgs(
+        model_type=model_type, do_sample=False, max_length=10, top_p=0.0
+    )
+    conv_ai_model.device = "cpu"
+    conv_ai_model._special_token_ids = SPECIAL_TOKEN_IDS
+
+    personality = [[10, 11], [12]]
+    history = [[20, 21], [22, 23]]
+    with torch.no_grad():
+        expected = full_prefix_greedy_decode(model, personality, history, 10)
+        actual = conv_ai_model.sample_sequence(
+            personality, history, None, model, conv_ai_model.args
+        )
+
+    assert len(expected) == 10
+    assert actual == expected